@@ -1,19 +1,27 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import asyncio
 import os
 import traceback
-from itertools import chain
+from bisect import bisect_right
+from itertools import accumulate
+from operator import attrgetter
 from pathlib import Path
 import re
 from contextlib import redirect_stdout
 from io import StringIO
-from sys import maxsize
 from collections import Counter
 
 import discord
+import numpy as np
 from discord.ext import commands
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 channels_path = Path(__file__).parent / "categories.txt"
 
 bot = commands.Bot(
@@ -32,56 +40,134 @@ CHANNEL_OWNER_PERMS = discord.PermissionOverwrite(
     manage_messages=True,
 )
 
+CODE_BLOCK_RE = re.compile(r"```(?:python)?(.*?)```", re.DOTALL)
 
-def get_project_categories(guild):
-    with channels_path.open() as f:
-        return [discord.utils.get(guild.categories, id=int(line.strip())) for line in f]
 
+# ids from `categories.txt`, reparsed only when the file's mtime changes
+_category_ids_cache = None
+_category_ids_mtime = None
 
-def get_archive_category(guild):
-    return discord.utils.get(guild.categories, name="Archive")
+# guild id -> archive category id (None if the guild has no archive)
+_archive_cat_id_by_guild = {}
 
 
-def score(arr): 
-    return sum(e**2 for e in arr)
+def get_project_category_ids():
+    global _category_ids_cache, _category_ids_mtime
+    mtime = channels_path.stat().st_mtime
+    if _category_ids_cache is None or mtime != _category_ids_mtime:
+        _category_ids_cache = [int(tok) for tok in channels_path.read_bytes().split()]
+        _category_ids_mtime = mtime
+    return _category_ids_cache
 
 
-# find sums between dividers
-def sum_div(arr, dividers): 
-    start_indices = (0,) + dividers
-    end_indices = dividers + (len(arr),)
-    return [sum(arr[i:j]) for i, j in zip(start_indices, end_indices)]
+def get_project_categories(guild):
+    by_id = {c.id: c for c in guild.categories}
+    return [by_id.get(i) for i in get_project_category_ids()]
+
+
+def get_archive_category(guild):
+    cat_id = _archive_cat_id_by_guild.get(guild.id)
+    cat = guild.get_channel(cat_id) if cat_id is not None else None
+    # the cached category may have been renamed or deleted since
+    if cat is None or cat.name != "Archive":
+        cat = discord.utils.get(guild.categories, name="Archive")
+        _archive_cat_id_by_guild[guild.id] = cat.id if cat is not None else None
+    return cat
+
+
+# map role names to roles, keeping the first role of each name
+# like `discord.utils.get` would
+def roles_by_name(guild):
+    return {r.name: r for r in reversed(guild.roles)}
+
+
+# await `coros` concurrently, running at most `limit` at once
+async def gather_bounded(coros, limit=5):
+    sem = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
+# DP kernel for `balance_categories`, compiled with numba when available
+# `counts` is an int64 array of sizes, `num_cats >= 2` the number of groups
+# returns the `parent` table of split points
+def _balance_dp(counts, num_cats): 
+    arr_len = counts.shape[0]
+    pref = np.zeros(arr_len + 1, dtype=np.int64)
+    for i in range(arr_len): 
+        pref[i + 1] = pref[i] + counts[i]
+
+    # `dp[k, i]` is the minimal score of splitting `arr[:i]` into `k` groups
+    # `parent[k, i]` is the start of the last group in that split
+    dp = np.zeros((num_cats + 1, arr_len + 1), dtype=np.int64)
+    parent = np.zeros((num_cats + 1, arr_len + 1), dtype=np.int64)
+    for i in range(arr_len + 1): 
+        dp[1, i] = pref[i] * pref[i]  # a single group is the whole prefix
+    for k in range(2, num_cats + 1): 
+        for i in range(k, arr_len + 1): 
+            # only `dp[k - 1, j]` with `j >= k - 1` is finite
+            best_j = k - 1
+            best = dp[k - 1, best_j] + (pref[i] - pref[best_j]) ** 2
+            for j in range(k, i): 
+                cand = dp[k - 1, j] + (pref[i] - pref[j]) ** 2
+                if cand < best: 
+                    best = cand
+                    best_j = j
+            dp[k, i] = best
+            parent[k, i] = best_j
+    return parent
+
+
+# NumPy fallback for `_balance_dp` when numba is not installed
+def _balance_dp_numpy(counts, num_cats): 
+    arr_len = len(counts)
+    pref = np.concatenate(([0], np.cumsum(counts)))
+
+    dp = np.full((num_cats + 1, arr_len + 1), np.iinfo(np.int64).max)
+    parent = np.zeros_like(dp, dtype=np.int32)
+    dp[1] = pref ** 2
+    for k in range(2, num_cats + 1): 
+        for i in range(k, arr_len + 1): 
+            cand = dp[k - 1, k - 1:i] + (pref[i] - pref[k - 1:i]) ** 2
+            j = cand.argmin()
+            parent[k, i] = k - 1 + j
+            dp[k, i] = cand[j]
+    return parent
+
+
+if numba is not None: 
+    _balance_dp = numba.njit(cache=True, nogil=True)(_balance_dp)
+else: 
+    _balance_dp = _balance_dp_numpy
 
 
 # `arr` is an array of sizes
 # `num_cats` is the number of categories
 # returns indices that divides `arr` up
 # into groups of roughly the same size
+#
+# Partitions `arr` into `num_cats` contiguous, non-empty segments minimizing
+# the sum of squared segment sums, in O(N^2 * K) time and O(N * K) memory.
+#
+# Runs compiled code without the GIL when numba is installed, so callers on
+# the event loop should run it in an executor.
 def balance_categories(arr, num_cats): 
-    num_divs = num_cats - 1  # number of dividers
-    data = {  # must add indirection to be writable from nested function
-        "best": (0,) * num_divs,
-        "top_score": maxsize
-    }
-    arr_len = len(arr)
-
-    # `m` is the number of dividers left to place
-    # `i` is the current index at which we are looking to place a divider
-    # `cur_indices` is a partial candidate list of divisors
-    # effect: writes optimal divisors and score in `data`
-    # returns None
-    def bal_cat_rec(m, i, cur_indices): 
-        if m == 0: 
-            new_score = score(sum_div(arr, cur_indices))
-            if new_score < data["top_score"]: 
-                data["top_score"] = new_score
-                data["best"] = cur_indices
-        else: 
-            for j in range(i, arr_len): 
-                bal_cat_rec(m-1, j+1, cur_indices + (j,))
-
-    bal_cat_rec(num_divs, 0, ())
-    return list(data["best"])
+    if num_cats <= 1: 
+        return []
+    counts = np.asarray(arr, dtype=np.int64)
+    parent = _balance_dp(counts, num_cats)
+
+    # walk back from the full array to recover the dividers
+    dividers = []
+    i = len(counts)
+    for k in range(num_cats, 1, -1): 
+        i = int(parent[k, i])
+        dividers.append(i)
+    return dividers[::-1]
 
 
 @bot.command()
@@ -95,9 +181,10 @@ async def get_categories(ctx):
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def set_categories(ctx, *categories: discord.CategoryChannel):
-    with channels_path.open("w") as f:
-        for category in categories:
-            f.write(str(category.id) + "\n")
+    global _category_ids_cache, _category_ids_mtime
+    channels_path.write_text("".join(f"{c.id}\n" for c in categories))
+    _category_ids_cache = [c.id for c in categories]
+    _category_ids_mtime = channels_path.stat().st_mtime
     await ctx.send(f"New project categories: {[c.name for c in categories]}")
 
 @bot.command()
@@ -107,10 +194,11 @@ async def sort(ctx: discord.ext.commands.Context):
     moves_made = 0
     renames_made = 0
 
+    renames = []
+
     categories = get_project_categories(ctx.guild)
-    channels = sorted(
-        chain.from_iterable(c.channels for c in categories), key=lambda ch: ch.name
-    )
+    channels = [ch for c in categories for ch in c.channels]
+    channels.sort(key=attrgetter("name"))
     category_channels = {}
 
     # balanced categorizer
@@ -118,9 +206,17 @@ async def sort(ctx: discord.ext.commands.Context):
     # of the frequencies. Isolate the frequencies, then run the balancer
     # to get the dividers. Then produce the segments from the dividers. 
     letters = [ch.name[0].upper() for ch in channels]
-    letter_frequencies = sorted(Counter("".join(letters)).items())
-    counts = list(map(lambda x: x[1], letter_frequencies))
-    dividers = balance_categories(counts, len(categories))
+    letter_frequencies = sorted(Counter(letters).items())
+    counts = np.fromiter(
+        (n for _, n in letter_frequencies),
+        dtype=np.int64,
+        count=len(letter_frequencies),
+    )
+    pref = [0, *accumulate(counts)]
+    # the DP (and its first numba compile) shouldn't block the event loop
+    dividers = await asyncio.get_running_loop().run_in_executor(
+        None, balance_categories, counts, len(categories)
+    )
     segment_starts = [0] + dividers
     segment_ends = dividers + [len(counts)]
 
@@ -128,9 +224,9 @@ async def sort(ctx: discord.ext.commands.Context):
     # as well as the current category index
     for k, (i, j) in enumerate(zip(segment_starts, segment_ends)): 
         # convert indices on segments to indices on channels
-        # by summing frequencies
-        start_idx = sum(counts[:i])
-        end_idx = start_idx + sum(counts[i:j])
+        # via the prefix sums of the frequencies
+        start_idx = pref[i]
+        end_idx = pref[j]
         start_letter = letters[start_idx]
         end_letter = letters[end_idx - 1]
         cat = categories[k]
@@ -145,11 +241,17 @@ async def sort(ctx: discord.ext.commands.Context):
         if cat.name != new_cat_name:
             renames_made += 1
             print(f"Renaming {cat.name} to {new_cat_name}")
-            await cat.edit(name=new_cat_name)
+            renames.append(cat.edit(name=new_cat_name))
 
         # Save channels that should be in the category at the end of the run
         category_channels[cat.id] = channels[start_idx:end_idx]
 
+    # Renames are independent of each other, so send them concurrently.
+    # Moves stay sequential: every position edit rewrites the ordering of
+    # the whole channel list from the local cache, so concurrent moves
+    # would overwrite each other.
+    await gather_bounded(renames)
+
     # Shuffle channels around
     for category in categories:
         for i, channel in enumerate(category_channels[category.id]):
@@ -197,11 +299,12 @@ async def make_channel(ctx, owner: discord.Member, name: str):
         colour=discord.Colour.from_rgb(155, 89, 182),
         mentionable=True,
     )
-    lang_owner_role = discord.utils.get(ctx.guild.roles, name="Lang Channel Owner")
+    roles = roles_by_name(ctx.guild)
+    lang_owner_role = roles.get("Lang Channel Owner")
     await ctx.send(f"Created and assigned role {role.mention}.")
     await owner.add_roles(role, lang_owner_role)
-    channelbot_role = discord.utils.get(ctx.guild.roles, name="Channel Bot")
-    muted_role = discord.utils.get(ctx.guild.roles, name="muted")
+    channelbot_role = roles.get("Channel Bot")
+    muted_role = roles.get("muted")
     overwrites = {
         role: CHANNEL_OWNER_PERMS,
         channelbot_role: discord.PermissionOverwrite(view_channel=False),
@@ -210,17 +313,19 @@ async def make_channel(ctx, owner: discord.Member, name: str):
         ),
     }
     categories = get_project_categories(ctx.guild)
-    channels = []
-    for cat in categories:
-        channels.extend(cat.channels)
-    channels = sorted(channels, key=lambda channel: channel.name)
+    # the new channel goes right before the channel whose name follows it
+    # most closely, which a single sweep finds without sorting
+    name_lc = name.lower()
     position = len(categories[-1].channels)
     category = categories[-1]
-    for channel in channels:
-        if channel.name.lower() > name.lower():
-            position = channel.position
-            category = channel.category
-            break
+    next_lc = None
+    for cat in categories:
+        for channel in cat.channels:
+            channel_lc = channel.name.lower()
+            if channel_lc > name_lc and (next_lc is None or channel_lc < next_lc):
+                next_lc = channel_lc
+                position = channel.position
+                category = cat
     await new_channel.edit(category=category, position=position, overwrites=overwrites)
     await ctx.send(f"Set appropriate permissions for {new_channel.mention}. Done!")
 
@@ -231,7 +336,7 @@ async def archive(ctx):
     """Archive a channel."""
     await ctx.send("Archiving channel.")
     await ctx.channel.edit(category=get_archive_category(ctx.guild))
-    everyone = discord.utils.get(ctx.guild.roles, name="@everyone")
+    everyone = ctx.guild.default_role
     await ctx.channel.set_permissions(everyone, send_messages=False)
     for role in ctx.channel.overwrites:
         if role.name.startswith("lang: "):
@@ -253,7 +358,10 @@ async def run_python(ctx, *, code):
         )
         return await locals_["__ex"](ctx, globals_, locals_)
 
-    code = re.match("```(python)?(.*?)```", code, flags=re.DOTALL).group(2)
+    match = CODE_BLOCK_RE.match(code)
+    if match is None:
+        raise commands.BadArgument("Code must be wrapped in a code block.")
+    code = match.group(1)
     print(f"Running ```{code}```")
     stdout = StringIO()
     with redirect_stdout(stdout):
@@ -264,35 +372,51 @@ async def run_python(ctx, *, code):
 @bot.listen("on_message")
 async def on_message(message: discord.Message):
     """Listen for messages in archived channels to unarchive them."""
-    if (
-        message.guild is None
-        or message.channel.category is None
-        or message.channel.category != get_archive_category(message.guild)
-    ):
+    if message.guild is None:
+        return
+    cat_id = getattr(message.channel, "category_id", None)
+    if cat_id is None:
+        return
+    if message.guild.id in _archive_cat_id_by_guild:
+        archive_id = _archive_cat_id_by_guild[message.guild.id]
+    else:
+        archive = get_archive_category(message.guild)
+        archive_id = archive.id if archive is not None else None
+    if cat_id != archive_id:
         return
-    everyone = discord.utils.get(message.guild.roles, name="@everyone")
+    everyone = message.guild.default_role
     await message.channel.set_permissions(everyone, overwrite=None)
     await reposition_channel(message.channel, get_project_categories(message.guild))
     await message.channel.send("Channel unarchived!")
 
 
+@bot.listen("on_guild_channel_create")
+@bot.listen("on_guild_channel_delete")
+@bot.listen("on_guild_channel_update")
+async def forget_archive_category(channel, *_):
+    """Drop the guild's cached archive category id when a category changes."""
+    if isinstance(channel, discord.CategoryChannel):
+        _archive_cat_id_by_guild.pop(channel.guild.id, None)
+
+
 async def reposition_channel(channel, project_categories):
-    channels = sorted(
-        (ch for c in project_categories for ch in c.channels if ch.id != channel.id),
-        key=lambda ch: ch.name,
-    )
-    category = None
-    position = 0
-    for c in channels:
-        position = c.position
-        if c.name > channel.name:
-            if not category:
-                category = c.category
-            break
-        category = c.category
-    else:
+    channels = [
+        ch for c in project_categories for ch in c.channels if ch.id != channel.id
+    ]
+    channels.sort(key=attrgetter("name"))
+    k = bisect_right([ch.name for ch in channels], channel.name)
+    if k < len(channels):
+        # Take the place of the first channel sorting after this one,
+        # staying in the category of the channel before it
+        position = channels[k].position
+        category = channels[max(k - 1, 0)].category
+    elif channels:
         # Channel should be sorted last
-        position += 1
+        position = channels[-1].position + 1
+        category = channels[-1].category
+    else:
+        position = 1
+        category = None
     await channel.edit(category=category, position=position)
     print(f"Moved channel {channel.name}")
 
@@ -306,12 +430,11 @@ async def on_command_error(ctx, error):
 @bot.event
 async def on_guild_channel_update(before, after):
     """Move channels to the correct position if they got renamed."""
-    if not isinstance(after, discord.TextChannel):
+    if not isinstance(after, discord.TextChannel) or after.name == before.name:
         return
-    categories = get_project_categories(before.guild)
-    if not (after.category in categories and after.name != before.name):
+    if after.category_id not in get_project_category_ids():
         return
-    await reposition_channel(after, categories)
+    await reposition_channel(after, get_project_categories(before.guild))
 
 
 bot.run(os.getenv("CHANNELSORTER_TOKEN"))